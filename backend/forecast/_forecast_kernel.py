@@ -0,0 +1,87 @@
+# _forecast_kernel.py
+"""
+Numba kernel for evaluating the forecast tree ensembles on a single feature vector.
+
+sklearn's predict() spends far longer validating input and dispatching per-tree work
+than walking the trees, so for one row it's much faster to flatten every tree into
+shared node arrays once and walk them in compiled code.
+"""
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor, ExtraTreesRegressor
+from sklearn.tree import DecisionTreeRegressor
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    # numba is optional; without it the models' own predict() is used
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+# sklearn marks leaves with child index -1
+TREE_LEAF = -1
+
+
+@njit("f8(f4[:], i8[:], i8[:], i8[:], f8[:], f8[:], i8[:])", cache=True)
+def predict_forest(x, left, right, feature, threshold, value, roots):
+    """Mean leaf value over the trees starting at roots, for one feature vector x."""
+    total = 0.0
+    for root in roots:
+        node = root
+        while left[node] != TREE_LEAF:
+            # Same float32-feature vs float64-threshold comparison sklearn makes
+            if x[feature[node]] <= threshold[node]:
+                node = left[node]
+            else:
+                node = right[node]
+        total += value[node]
+    return total / len(roots)
+
+
+class ForestKernelModel:
+    """A fitted single-output tree regressor flattened for predict_forest."""
+
+    def __init__(self, model):
+        trees = [model] if isinstance(model, DecisionTreeRegressor) else model.estimators_
+        left, right, feature, threshold, value, roots = [], [], [], [], [], []
+        offset = 0
+
+        for tree in trees:
+            t = tree.tree_
+            is_leaf = t.children_left == TREE_LEAF
+            # Shift child indices into the shared arrays, leaving leaf markers alone
+            left.append(np.where(is_leaf, TREE_LEAF, t.children_left + offset))
+            right.append(np.where(is_leaf, TREE_LEAF, t.children_right + offset))
+            feature.append(t.feature)
+            threshold.append(t.threshold)
+            value.append(t.value[:, 0, 0])
+            roots.append(offset)
+            offset += t.node_count
+
+        self.model = model
+        self.left = np.concatenate(left).astype(np.int64)
+        self.right = np.concatenate(right).astype(np.int64)
+        self.feature = np.concatenate(feature).astype(np.int64)
+        self.threshold = np.concatenate(threshold).astype(np.float64)
+        self.value = np.concatenate(value).astype(np.float64)
+        self.roots = np.array(roots, dtype=np.int64)
+
+    def predict(self, X):
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        return np.array([
+            predict_forest(row, self.left, self.right, self.feature, self.threshold, self.value, self.roots)
+            for row in X
+        ])
+
+
+def compile_model(model):
+    """Wrap model in a ForestKernelModel when numba is available and it's a supported regressor."""
+    if not NUMBA_AVAILABLE:
+        return model
+    if not isinstance(model, (RandomForestRegressor, ExtraTreesRegressor, DecisionTreeRegressor)):
+        return model
+    if getattr(model, "n_outputs_", 1) != 1:
+        return model
+    return ForestKernelModel(model)
@@ -0,0 +1,33 @@
+# convert_to_onnx.py
+"""
+Convert the trained forecast models to ONNX so the API can serve them with ONNX Runtime.
+
+Run from the backend directory after (re)training the .pkl models:
+    python -m forecast.convert_to_onnx
+
+Needs skl2onnx (conversion only); the API itself only needs onnxruntime.
+"""
+import os
+from skl2onnx import convert_sklearn
+from skl2onnx.common.data_types import FloatTensorType
+from forecast.forecast_utils import HORIZONS, FEATURE_COLUMNS, load_models
+
+
+def convert_models():
+    """Write forecast_{h}h.onnx next to each forecast_{h}h.pkl."""
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    models = load_models(prefer_onnx=False, prefer_kernel=False)
+
+    for h in HORIZONS:
+        onnx_model = convert_sklearn(
+            models[h],
+            initial_types=[("input", FloatTensorType([None, len(FEATURE_COLUMNS)]))],
+        )
+        filepath = os.path.join(script_dir, f"forecast_{h}h.onnx")
+        with open(filepath, "wb") as f:
+            f.write(onnx_model.SerializeToString())
+        print(f"Saved {filepath}")
+
+
+if __name__ == "__main__":
+    convert_models()
@@ -1,52 +1,99 @@
 # forecast_utils.py
 import numpy as np
-import pandas as pd
 import joblib
 from datetime import datetime
+from forecast._forecast_kernel import compile_model
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    # ONNX Runtime is optional; the pickled sklearn models are used without it
+    ort = None
 
 # Horizons we trained
 HORIZONS = [1, 6, 12, 24]
 
-def load_models():
-    """Load trained models from disk into a dict."""
+# Feature order the models were trained with
+FEATURE_COLUMNS = [
+    "pm25", "t2m", "wind_speed", "relative_humidity",
+    "hour_sin", "hour_cos", "dow_sin", "dow_cos",
+]
+
+# Cyclical (sin, cos) encodings for every hour of the day and day of the week
+_HOUR_TABLE = np.column_stack([np.sin(2 * np.pi * np.arange(24) / 24), np.cos(2 * np.pi * np.arange(24) / 24)])
+_DOW_TABLE = np.column_stack([np.sin(2 * np.pi * np.arange(7) / 7), np.cos(2 * np.pi * np.arange(7) / 7)])
+
+class OnnxModel:
+    """ONNX Runtime session exposing the sklearn-style predict() forecast_pm25 uses."""
+
+    def __init__(self, path):
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict(self, X):
+        return self.session.run(None, {self.input_name: X})[0].ravel()
+
+
+def load_models(prefer_onnx=True, prefer_kernel=True):
+    """
+    Load trained models from disk into a dict.
+    Uses forecast_{h}h.onnx (see convert_to_onnx.py) when present and onnxruntime is installed,
+    otherwise tree ensembles are served by the numba kernel in _forecast_kernel.py when possible.
+    """
     import os
     models = {}
     # Get the directory where this script is located (forecast directory)
     script_dir = os.path.dirname(os.path.abspath(__file__))
     
     for h in HORIZONS:
+        onnx_path = os.path.join(script_dir, f"forecast_{h}h.onnx")
+        if prefer_onnx and ort is not None and os.path.exists(onnx_path):
+            models[h] = OnnxModel(onnx_path)
+            continue
+        
         filename = f"forecast_{h}h.pkl"
         filepath = os.path.join(script_dir, filename)
-        models[h] = joblib.load(filepath)
+        model = joblib.load(filepath)
+        feature_names = getattr(model, "feature_names_in_", None)
+        if feature_names is not None:
+            if list(feature_names) != FEATURE_COLUMNS:
+                raise ValueError(f"{filename} expects features {list(feature_names)}, not {FEATURE_COLUMNS}")
+            # Column order is checked above; drop the names so sklearn accepts the plain ndarray without warning
+            del model.feature_names_in_
+        models[h] = compile_model(model) if prefer_kernel else model
     return models
 
 
+def parse_datetime(value):
+    """Return value as a datetime, parsing ISO 8601 strings (including a trailing 'Z')."""
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+
+
 def make_features(latest_datetime, pm25, t2m, wind_speed, relative_humidity):
-    """Build feature vector from latest observation."""
-    dt = pd.to_datetime(latest_datetime)
+    """Build a (1, 8) float32 feature vector, in FEATURE_COLUMNS order, from latest observation."""
+    dt = parse_datetime(latest_datetime)
 
-    hour = dt.hour
-    dow = dt.dayofweek
+    hour_sin, hour_cos = _HOUR_TABLE[dt.hour]
+    dow_sin, dow_cos = _DOW_TABLE[dt.weekday()]
 
-    return pd.DataFrame([{
-        "pm25": pm25,
-        "t2m": t2m,
-        "wind_speed": wind_speed,
-        "relative_humidity": relative_humidity,
-        "hour_sin": np.sin(2 * np.pi * hour / 24),
-        "hour_cos": np.cos(2 * np.pi * hour / 24),
-        "dow_sin": np.sin(2 * np.pi * dow / 7),
-        "dow_cos": np.cos(2 * np.pi * dow / 7),
-    }])
+    return np.array([[
+        pm25,
+        t2m,
+        wind_speed,
+        relative_humidity,
+        hour_sin,
+        hour_cos,
+        dow_sin,
+        dow_cos,
+    ]], dtype=np.float32)
 
 
 def forecast_pm25(models, latest_datetime, pm25, t2m, wind_speed, relative_humidity):
     """Run forecasts for all horizons using the trained models."""
-    features = make_features(latest_datetime, pm25, t2m, wind_speed, relative_humidity)
-
-    predictions = {}
-    for h in HORIZONS:
-        pred = models[h].predict(features)[0]
-        predictions[f"+{h}h"] = round(pred, 2)
+    X = make_features(latest_datetime, pm25, t2m, wind_speed, relative_humidity)
 
-    return predictions
+    return {f"+{h}h": round(float(models[h].predict(X)[0]), 2) for h in HORIZONS}
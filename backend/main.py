@@ -1,17 +1,44 @@
 import os
-import csv
-import math
-import requests
-from typing import Optional
+import asyncio
+import logging
+from datetime import datetime
 from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 from routers import prediction_router
+from services.prediction_service import get_models, rebuild_csv_index
+from services.csv_index import close_index
+from forecast.forecast_utils import forecast_pm25
+from services.air_quality_service import (
+    close_http_client,
+    coalesce,
+    warm_up_distance_kernels,
+    start_csv_writer,
+    stop_csv_writer,
+    search_nearest_station,
+    get_pm25_sensor_ids,
+    get_latest_measurements,
+    get_weather_data,
+    save_airquality_csv,
+)
 
 # Load environment variables
 load_dotenv()
 
-app = FastAPI(title="Air Quality API", description="Get nearest air quality data using OpenAQ API")
+# WARNING by default; set LOG_LEVEL=DEBUG to see which data each prediction used
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "WARNING").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# orjson serializes responses several times faster than the stdlib json encoder
+app = FastAPI(
+    title="Air Quality API",
+    description="Get nearest air quality data using OpenAQ API",
+    default_response_class=ORJSONResponse
+)
 
 # Add CORS middleware to allow all origins
 app.add_middleware(
@@ -25,220 +52,91 @@ app.add_middleware(
 # Include routers
 app.include_router(prediction_router.router)
 
-# OpenAQ API configuration
-OPENAQ_BASE_URL = "https://api.openaq.org/v3"
-OPENAQ_API_KEY = os.getenv("OPENAQ_API_KEY")  # Optional, but recommended for higher rate limits
-OPEN_METEO_BASE_URL = "https://api.open-meteo.com/v1"
+@app.on_event("startup")
+async def start_background_csv_writer():
+    """Start the task that appends CSV rows off the request path."""
+    start_csv_writer()
 
-def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
-    """
-    Calculate the great circle distance between two points 
-    on the earth (specified in decimal degrees) using the Haversine formula.
-    Returns distance in kilometers.
-    """
-    # Convert decimal degrees to radians
-    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
-    
-    # Haversine formula
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a))
-    
-    # Radius of earth in kilometers
-    r = 6371
-    
-    return c * r
-
-def search_stations_by_radius(lat: float, lon: float, radius_meters: int) -> Optional[list]:
-    """
-    Search for air quality stations within a given radius from coordinates.
-    Returns list of stations or None if request fails.
-    """
-    url = f"{OPENAQ_BASE_URL}/locations"
-    params = {
-        "coordinates": f"{lat},{lon}",
-        "radius": radius_meters,
-        "limit": 100  # Get more stations to find the closest one
-    }
-    
-    headers = {}
-    if OPENAQ_API_KEY:
-        headers["X-API-Key"] = OPENAQ_API_KEY
-    
+@app.on_event("startup")
+async def build_csv_index():
+    """Index the latest row of each CSV file so predictions don't scan data/."""
     try:
-        response = requests.get(url, params=params, headers=headers, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        return data.get("results", [])
-    except requests.RequestException as e:
-        print(f"Error searching stations: {e}")
-        return None
+        await asyncio.to_thread(rebuild_csv_index)
+    except Exception as e:
+        # Readers fall back to scanning the CSV files
+        logger.error("Error building CSV index: %s", e)
 
-def get_sensor_parameter(sensor_id: int) -> Optional[str]:
-    """
-    Get parameter name for a specific sensor.
-    Returns parameter name or None if request fails.
-    """
-    url = f"{OPENAQ_BASE_URL}/sensors/{sensor_id}"
-    headers = {}
-    if OPENAQ_API_KEY:
-        headers["X-API-Key"] = OPENAQ_API_KEY
-    
+@app.on_event("startup")
+async def warm_up_distance_kernels_on_startup():
+    """Compile/load the numba distance kernels before the first station search."""
     try:
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        results = data.get("results", [])
-        if results:
-            parameter = results[0].get("parameter", {})
-            return parameter.get("name")
-    except requests.RequestException as e:
-        print(f"Error getting sensor parameter: {e}")
-    return None
+        warm_up_distance_kernels()
+    except Exception as e:
+        logger.error("Error warming up distance kernels: %s", e)
 
-def get_latest_measurements(location_id: int) -> Optional[dict]:
-    """
-    Get latest measurements for a specific location.
-    Returns measurement data or None if request fails.
-    """
-    url = f"{OPENAQ_BASE_URL}/locations/{location_id}/latest"
-    params = {}
-    
-    headers = {}
-    if OPENAQ_API_KEY:
-        headers["X-API-Key"] = OPENAQ_API_KEY
-    
+@app.on_event("startup")
+async def load_forecast_models():
+    """Load the forecast models once and run a dummy forecast so the first request isn't cold."""
     try:
-        response = requests.get(url, params=params, headers=headers, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        return data.get("results", [])
-    except requests.RequestException as e:
-        print(f"Error getting measurements: {e}")
-        return None
+        forecast_pm25(get_models(), datetime.now(), 10.0, 20.0, 3.0, 50.0)
+    except Exception as e:
+        # Keep serving /air-quality; predictions will retry loading on demand
+        logger.error("Error loading forecast models: %s", e)
 
-def get_weather_data(lat: float, lon: float) -> Optional[dict]:
-    """
-    Get current weather data from Open-Meteo API.
-    Returns weather data including temperature, humidity, and wind speed or None if request fails.
-    """
-    url = f"{OPEN_METEO_BASE_URL}/forecast"
-    params = {
-        "latitude": lat,
-        "longitude": lon,
-        "current": "temperature_2m,relative_humidity_2m,wind_speed_10m"
-    }
-    
-    try:
-        response = requests.get(url, params=params, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        
-        current_data = data.get("current", {})
-        return {
-            "temperature_celsius": current_data.get("temperature_2m"),
-            "relative_humidity": current_data.get("relative_humidity_2m"),
-            "wind_speed": current_data.get("wind_speed_10m"),
-            "weather_time": current_data.get("time")
-        }
-    except requests.RequestException as e:
-        print(f"Error getting weather data: {e}")
-        return None
+@app.on_event("shutdown")
+async def shutdown_http_client():
+    """Close the shared outbound HTTP connection pool."""
+    await close_http_client()
 
-def save_airquality_csv(data: dict, lat: float, lon: float) -> None:
-    """
-    Save air quality and weather data to a CSV file.
-    Creates data directory if it doesn't exist.
-    """
-    try:
-        # Create data directory if it doesn't exist
-        data_dir = "data"
-        if not os.path.exists(data_dir):
-            os.makedirs(data_dir)
-        
-        # Round coordinates to 2 decimal places for clean filenames
-        lat_rounded = round(lat, 2)
-        lon_rounded = round(lon, 2)
-        
-        # Create filename
-        filename = f"airquality_{lat_rounded}_{lon_rounded}.csv"
-        filepath = os.path.join(data_dir, filename)
-        
-        # Prepare CSV data with the required mapping
-        csv_data = {
-            "date": data.get("weather_time"),
-            "pm25": data.get("pm25"),
-            "t2m": data.get("temperature_celsius"),
-            "wind_speed": data.get("wind_speed"),
-            "relative_humidity": data.get("relative_humidity")
-        }
-        
-        # Write to CSV file
-        with open(filepath, 'w', newline='', encoding='utf-8') as csvfile:
-            fieldnames = ["date", "pm25", "t2m", "wind_speed", "relative_humidity"]
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            
-            # Write header
-            writer.writeheader()
-            # Write data row
-            writer.writerow(csv_data)
-            
-        print(f"CSV file saved: {filepath}")
-        
-    except Exception as e:
-        print(f"Error saving CSV file: {e}")
+@app.on_event("shutdown")
+async def shutdown_csv_writer():
+    """Write out any CSV rows still queued, then close the CSV index."""
+    await stop_csv_writer()
+    close_index()
 
 @app.get("/air-quality")
 async def get_air_quality(
-    lat: float = Query(..., description="Latitude coordinate"),
-    lon: float = Query(..., description="Longitude coordinate")
+    lat: float = Query(..., description="Latitude coordinate", ge=-90, le=90),
+    lon: float = Query(..., description="Longitude coordinate", ge=-180, le=180)
 ):
     """
     Get nearest air quality data for given coordinates
     and current temperature data from Open-Meteo API.
-    Searches progressively with increasing radius: 1km → 5km → 10km → 25km
+    Searches within 1km first, then falls back to a single 25km search.
     """
-    # Progressive radius search in meters
-    search_radii = [1000, 5000, 10000, 25000]
-    
-    nearest_station = None
-    min_distance = float('inf')
+    # Concurrent requests for the same point share one set of upstream calls
+    return await coalesce(("air-quality", lat, lon), lambda: _fetch_air_quality(lat, lon))
+
+async def _fetch_air_quality(lat: float, lon: float) -> dict:
+    """Fetch weather alongside the OpenAQ lookups and build the /air-quality response."""
+    # Weather doesn't depend on the OpenAQ lookups, so fetch it concurrently
+    weather_task = asyncio.create_task(get_weather_data(lat, lon))
+    try:
+        return await _build_air_quality_response(lat, lon, weather_task)
+    finally:
+        # No-op once awaited; stops the fetch if a lookup failed
+        weather_task.cancel()
+
+async def _build_air_quality_response(lat: float, lon: float, weather_task: asyncio.Task) -> dict:
+    """Run the OpenAQ lookups and combine them with the pending weather fetch."""
+    # Try 1km first: in dense areas the 100-station limit could cut the true nearest station
+    # out of a 25km response. A 25km search already covers everything in between.
+    result = await search_nearest_station(lat, lon, [1000, 25000])
+    if result is None:
+        raise HTTPException(status_code=500, detail="Failed to fetch station data from OpenAQ API")
     
-    # Search with progressive radius
-    for radius in search_radii:
-        stations = search_stations_by_radius(lat, lon, radius)
-        
-        if stations is None:
-            raise HTTPException(status_code=500, detail="Failed to fetch station data from OpenAQ API")
-        
-        if stations:
-            # Find the nearest station among all found stations
-            for station in stations:
-                station_lat = station.get("coordinates", {}).get("latitude")
-                station_lon = station.get("coordinates", {}).get("longitude")
-                
-                if station_lat is not None and station_lon is not None:
-                    distance = haversine_distance(lat, lon, station_lat, station_lon)
-                    
-                    if distance < min_distance:
-                        min_distance = distance
-                        nearest_station = station
-            
-            # If we found a station, break out of the radius loop
-            if nearest_station:
-                break
+    nearest_station, min_distance = result
     
     # If no station found within 25km, still try to get weather data
     if not nearest_station:
-        weather_data = get_weather_data(lat, lon)
+        weather_data = await weather_task
         response = {"message": "No air quality station found within 25 km"}
         
         if weather_data:
-            response["temperature_celsius"] = weather_data["temperature_celsius"]
+            response["temperature_celsius"] = weather_data["t2m"]
             response["relative_humidity"] = weather_data["relative_humidity"]
             response["wind_speed"] = weather_data["wind_speed"]
-            response["weather_time"] = weather_data["weather_time"]
+            response["weather_time"] = weather_data["datetime"]
         else:
             response["temperature_celsius"] = None
             response["relative_humidity"] = None
@@ -247,7 +145,7 @@ async def get_air_quality(
             response["warning"] = "Weather data also unavailable"
         
         # Save data to CSV file (even when no air quality station found)
-        save_airquality_csv(response, lat, lon)
+        save_airquality_csv({**(weather_data or {}), "pm25": None}, lat, lon, round_digits=2)
         
         return response
     
@@ -256,7 +154,7 @@ async def get_air_quality(
     if not location_id:
         raise HTTPException(status_code=500, detail="Station ID not found")
     
-    measurements = get_latest_measurements(location_id)
+    measurements = await get_latest_measurements(location_id)
     if measurements is None:
         raise HTTPException(status_code=500, detail="Failed to fetch measurement data from OpenAQ API")
     
@@ -264,8 +162,8 @@ async def get_air_quality(
     pm25_value = None
     last_updated = None
     
-    # Cache for sensor parameters to avoid repeated API calls
-    sensor_params_cache = {}
+    # The station search already told us which sensors measure PM2.5
+    pm25_sensor_ids = get_pm25_sensor_ids(nearest_station)
     
     for measurement in measurements:
         sensor_id = measurement.get("sensorsId")
@@ -275,17 +173,11 @@ async def get_air_quality(
         if datetime_info.get("utc"):
             last_updated = datetime_info.get("utc")
         
-        # Get parameter name for this sensor
-        if sensor_id not in sensor_params_cache:
-            sensor_params_cache[sensor_id] = get_sensor_parameter(sensor_id)
-        
-        parameter_name = sensor_params_cache[sensor_id]
-        
-        if parameter_name == "pm25" and value is not None:
+        if sensor_id in pm25_sensor_ids and value is not None:
             pm25_value = value
     
-    # Fetch weather data from Open-Meteo API
-    weather_data = get_weather_data(lat, lon)
+    # Weather data from Open-Meteo API was fetched alongside the OpenAQ calls
+    weather_data = await weather_task
     
     # Prepare response with both air quality and temperature data
     response_data = {
@@ -299,10 +191,10 @@ async def get_air_quality(
     
     # Add weather data if available
     if weather_data:
-        response_data["temperature_celsius"] = weather_data["temperature_celsius"]
+        response_data["temperature_celsius"] = weather_data["t2m"]
         response_data["relative_humidity"] = weather_data["relative_humidity"]
         response_data["wind_speed"] = weather_data["wind_speed"]
-        response_data["weather_time"] = weather_data["weather_time"]
+        response_data["weather_time"] = weather_data["datetime"]
     else:
         response_data["temperature_celsius"] = None
         response_data["relative_humidity"] = None
@@ -311,7 +203,7 @@ async def get_air_quality(
         response_data["warning"] = "Weather data unavailable"
     
     # Save data to CSV file
-    save_airquality_csv(response_data, lat, lon)
+    save_airquality_csv({**(weather_data or {}), "pm25": pm25_value}, lat, lon, round_digits=2)
     
     return response_data
 
@@ -328,4 +220,6 @@ async def root():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # "auto" resolves to uvloop and httptools when installed (see requirements.txt),
+    # falling back to asyncio's default loop on Windows where uvloop isn't available
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="auto", http="auto")
\ No newline at end of file
@@ -1,11 +1,10 @@
 # prediction_router.py
+import asyncio
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel, Field
 from typing import Optional, Dict, Any
-from services.prediction_service import predict_air_quality
-from services.air_quality_service import get_air_quality_data
-import pandas as pd
-import os
+from services.prediction_service import predict_air_quality, get_data_from_csv_by_coordinates, CSV_VALUE_COLUMNS
+from services.air_quality_service import get_air_quality_data, coalesce
 
 router = APIRouter(prefix="/predict", tags=["predictions"])
 
@@ -15,8 +14,8 @@ class PredictionRequest(BaseModel):
     t2m: float = Field(None, description="Current temperature (°C) - optional, uses latest from CSV if not provided")
     wind_speed: float = Field(None, description="Current wind speed (m/s) - optional, uses latest from CSV if not provided", ge=0)
     relative_humidity: float = Field(None, description="Current relative humidity (%) - optional, uses latest from CSV if not provided", ge=0, le=100)
-    lat: float = Field(None, description="Latitude coordinate - optional")
-    lon: float = Field(None, description="Longitude coordinate - optional")
+    lat: float = Field(None, description="Latitude coordinate - optional", ge=-90, le=90)
+    lon: float = Field(None, description="Longitude coordinate - optional", ge=-180, le=180)
 
 class PredictionResponse(BaseModel):
     """Response model for air quality prediction."""
@@ -36,7 +35,7 @@ async def predict_pm25_levels(request: PredictionRequest):
     from CSV files for predictions.
     """
     try:
-        result = predict_air_quality(
+        result = await predict_air_quality(
             pm25=request.pm25,
             t2m=request.t2m,
             wind_speed=request.wind_speed,
@@ -45,15 +44,20 @@ async def predict_pm25_levels(request: PredictionRequest):
             lon=request.lon
         )
         
-        return PredictionResponse(**result)
+        if result.status != 'success':
+            raise HTTPException(status_code=500, detail=result.message)
         
+        return PredictionResponse(status=result.status, predictions=result.predictions)
+        
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 class CoordinateRequest(BaseModel):
-    lat: float = Field(..., description="Latitude coordinate")
-    lon: float = Field(..., description="Longitude coordinate")
+    lat: float = Field(..., description="Latitude coordinate", ge=-90, le=90)
+    lon: float = Field(..., description="Longitude coordinate", ge=-180, le=180)
 
 
 @router.post("/from-coordinates", response_model=PredictionResponse)
@@ -63,53 +67,53 @@ async def predict_from_coordinates(request: CoordinateRequest):
     
     This endpoint:
     1. Fetches current air quality data from the API for the given coordinates
-    2. Creates a CSV file with the fetched data
-    3. Uses that CSV file to generate predictions
+    2. Appends the fetched data to the CSV file for those coordinates
+    3. Generates predictions from the freshly fetched data, filling any missing value
+       (e.g. PM2.5 when no station reports it) from the latest row stored before this fetch,
+       else from defaults
     4. Returns the predictions
     
     Args:
         request: CoordinateRequest with latitude and longitude
     
     Returns:
-        PredictionResponse with predictions based on the newly created CSV data
+        PredictionResponse with predictions based on the freshly fetched data
     """
     try:
-        # Step 1: Fetch air quality data from API
-        air_quality_data = await get_air_quality_data(request.lat, request.lon)
+        # The fetch appends a row that's blank wherever the fetch came up empty, so read the
+        # stored latest row for gap-filling before it can be superseded
+        stored = await asyncio.to_thread(get_data_from_csv_by_coordinates, request.lat, request.lon) or {}
+        
+        # Step 1: Fetch air quality data from API (get_air_quality_data queues the CSV row)
+        # Concurrent requests for the same coordinates share a single fetch
+        air_quality_data = await coalesce(
+            ("air-quality-data", request.lat, request.lon),
+            lambda: get_air_quality_data(request.lat, request.lon)
+        )
         
         if not air_quality_data or 'current' not in air_quality_data:
             raise HTTPException(status_code=404, detail="No air quality data found for these coordinates")
         
-        current_data = air_quality_data['current']
-        
-        # Step 2: Create CSV file with the fetched data
-        csv_filename = f"airquality_{request.lat}_{request.lon}.csv"
-        csv_filepath = os.path.join("data", csv_filename)
+        # Step 2: Predict from the fetched values themselves. Re-reading the CSV could pick an
+        # older row: rows aren't always appended in date order, and "latest" means greatest date
+        current = air_quality_data['current']
+        inputs = {}
+        for column in CSV_VALUE_COLUMNS:
+            value = current.get(column)
+            inputs[column] = value if value is not None else stored.get(column)
         
-        # Ensure data directory exists
-        os.makedirs("data", exist_ok=True)
-        
-        # Create DataFrame with the current data
-        df_data = {
-            'date': [current_data['datetime']],
-            'pm25': [current_data.get('pm25', 25.0)],
-            't2m': [current_data.get('t2m', 20.0)],
-            'wind_speed': [current_data.get('wind_speed', 5.0)],
-            'relative_humidity': [current_data.get('relative_humidity', 60.0)]
-        }
-        
-        df = pd.DataFrame(df_data)
-        df.to_csv(csv_filepath, index=False)
-        
-        print(f"Created CSV file: {csv_filepath} with data: {df_data}")
-        
-        # Step 3: Generate predictions using the newly created CSV
-        result = predict_air_quality(
+        result = await predict_air_quality(
+            **inputs,
             lat=request.lat,
-            lon=request.lon
+            lon=request.lon,
+            timestamp=current.get('datetime'),
+            refresh=True
         )
         
-        return PredictionResponse(**result)
+        if result.status != 'success':
+            raise HTTPException(status_code=500, detail=result.message)
+        
+        return PredictionResponse(status=result.status, predictions=result.predictions)
         
     except HTTPException:
         raise
@@ -1,9 +1,30 @@
 import os
 import csv
+import json
 import math
-import requests
+import asyncio
+import logging
+import sqlite3
+import functools
+import httpx
+import numpy as np
 from typing import Optional
+from cachetools import TTLCache
 from dotenv import load_dotenv
+from services.csv_index import upsert_latest_rows, csv_path_for
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    # numba is optional; without it the kernels below run as plain Python
+    NUMBA_AVAILABLE = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
@@ -13,6 +34,110 @@ OPENAQ_BASE_URL = "https://api.openaq.org/v3"
 OPENAQ_API_KEY = os.getenv("OPENAQ_API_KEY")  # Optional, but recommended for higher rate limits
 OPEN_METEO_BASE_URL = "https://api.open-meteo.com/v1"
 
+# Sent per OpenAQ request rather than set on the client, so the key never goes to Open-Meteo
+OPENAQ_HEADERS = {"X-API-Key": OPENAQ_API_KEY} if OPENAQ_API_KEY else {}
+
+# Cap on concurrent outbound requests, to stay within OpenAQ/Open-Meteo rate limits
+MAX_CONCURRENT_REQUESTS = 20
+
+# Largest upstream response body we'll decode; anything bigger is treated as a failure
+MAX_RESPONSE_BYTES = 5 * 1024 * 1024
+
+# OpenAQ rejects location searches wider than 25km
+MAX_SEARCH_RADIUS_METERS = 25000
+
+# Shared HTTP client, created on first use and closed on shutdown.
+# HTTP/2 multiplexes concurrent requests to the same host over one connection.
+_http_client = None
+_request_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+def get_http_client() -> httpx.AsyncClient:
+    """Get the shared HTTP client, creating it if necessary."""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            timeout=10,
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=50),
+            headers={"Accept-Encoding": "gzip"},
+        )
+    return _http_client
+
+async def close_http_client() -> None:
+    """Close the shared HTTP client and its connection pool."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+async def http_get_json(url: str, **kwargs):
+    """
+    GET a URL through the shared client and decode its JSON body.
+    Raises httpx.HTTPError on a failed request and ValueError on an oversized or malformed body.
+    """
+    async with _request_semaphore:
+        async with get_http_client().stream("GET", url, **kwargs) as response:
+            response.raise_for_status()
+            
+            content_length = response.headers.get("content-length")
+            if content_length and int(content_length) > MAX_RESPONSE_BYTES:
+                raise ValueError(f"Response from {url} too large ({content_length} bytes)")
+            
+            body = bytearray()
+            async for chunk in response.aiter_bytes():
+                body += chunk
+                if len(body) > MAX_RESPONSE_BYTES:
+                    raise ValueError(f"Response from {url} exceeded {MAX_RESPONSE_BYTES} bytes")
+    
+    return json.loads(body)
+
+# Process-wide caches for upstream lookups (TTL in seconds)
+_station_cache = TTLCache(maxsize=1024, ttl=1800)
+_weather_cache = TTLCache(maxsize=1024, ttl=900)
+
+def _grid_key(lat: float, lon: float) -> tuple:
+    """Snap coordinates to a ~100 m grid so nearby lookups share cache entries."""
+    return round(lat, 3), round(lon, 3)
+
+def async_cached(cache: TTLCache, key=lambda *args: args):
+    """Cache successful (non-None) results of an async function."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args):
+            cache_key = key(*args)
+            try:
+                return cache[cache_key]
+            except KeyError:
+                pass
+            result = await func(*args)
+            if result is not None:
+                cache[cache_key] = result
+            return result
+        return wrapper
+    return decorator
+
+# Lookups currently in flight, so concurrent identical requests can share them
+_inflight = {}
+
+async def coalesce(key, coro_factory):
+    """
+    Run coro_factory() at most once at a time per key.
+    Concurrent callers with the same key await the same result instead of repeating the work.
+    """
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(coro_factory())
+        _inflight[key] = task
+        
+        def _forget(done_task):
+            if _inflight.get(key) is done_task:
+                del _inflight[key]
+        task.add_done_callback(_forget)
+    
+    # Shielded so one caller disconnecting doesn't cancel the lookup for everyone else
+    return await asyncio.shield(task)
+
+@njit("f8(f8, f8, f8, f8)", cache=True, fastmath=True)
 def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     """
     Calculate the great circle distance between two points 
@@ -20,7 +145,10 @@ def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> fl
     Returns distance in kilometers.
     """
     # Convert decimal degrees to radians
-    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+    lat1 = math.radians(lat1)
+    lon1 = math.radians(lon1)
+    lat2 = math.radians(lat2)
+    lon2 = math.radians(lon2)
     
     # Haversine formula
     dlat = lat2 - lat1
@@ -33,69 +161,148 @@ def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> fl
     
     return c * r
 
-def search_stations_by_radius(lat: float, lon: float, radius_meters: int) -> Optional[list]:
-    """Search for air quality monitoring stations within a radius."""
-    headers = {}
-    if OPENAQ_API_KEY:
-        headers["X-API-Key"] = OPENAQ_API_KEY
+@njit("Tuple((i8, f8))(f8, f8, f8[:], f8[:])", cache=True, fastmath=True)
+def nearest_station_index(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> tuple:
+    """
+    Find the index of the closest point in a single pass over the arrays.
+    Returns (index, distance_km).
+    """
+    best_index = -1
+    best_distance = np.inf
+    for i in range(lats.shape[0]):
+        distance = haversine_distance(lat, lon, lats[i], lons[i])
+        if distance < best_distance:
+            best_distance = distance
+            best_index = i
+    return best_index, best_distance
+
+# Below this many stations the thread start-up of the parallel kernel costs more than it saves
+PARALLEL_STATION_THRESHOLD = 50
+
+@njit("Tuple((i8, f8))(f8, f8, f8[:], f8[:])", parallel=True, cache=True, fastmath=True)
+def nearest_station_index_parallel(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> tuple:
+    """
+    Multi-threaded variant of nearest_station_index for large station arrays.
+    Returns (index, distance_km).
+    """
+    distances = np.empty(lats.shape[0])
+    for i in prange(lats.shape[0]):
+        distances[i] = haversine_distance(lat, lon, lats[i], lons[i])
+    best_index = distances.argmin()
+    return best_index, distances[best_index]
+
+def haversine_distances(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """
+    Vectorized Haversine distance from one point to arrays of points.
+    Returns distances in kilometers.
+    """
+    lat_rad, lon_rad = math.radians(lat), math.radians(lon)
+    lats, lons = np.radians(lats), np.radians(lons)
+    
+    dlat = lats - lat_rad
+    dlon = lons - lon_rad
+    a = np.sin(dlat / 2) ** 2 + math.cos(lat_rad) * np.cos(lats) * np.sin(dlon / 2) ** 2
     
+    return 6371 * 2 * np.arcsin(np.sqrt(a))
+
+def warm_up_distance_kernels() -> None:
+    """Call each distance kernel once so JIT/cache loading happens at startup, not on a request."""
+    lats = np.zeros(1, dtype=np.float64)
+    lons = np.ones(1, dtype=np.float64)
+    haversine_distance(0.0, 0.0, 1.0, 1.0)
+    nearest_station_index(0.0, 0.0, lats, lons)
+    nearest_station_index_parallel(0.0, 0.0, lats, lons)
+    haversine_distances(0.0, 0.0, lats, lons)
+
+def get_pm25_sensor_ids(station: dict) -> set:
+    """Get the IDs of a station's PM2.5 sensors from its embedded sensor metadata."""
+    return {
+        sensor.get("id") for sensor in station.get("sensors", [])
+        if sensor.get("parameter", {}).get("name") == "pm25"
+    }
+
+def has_pm25_sensor(station: dict) -> bool:
+    """Check whether a station reports PM2.5."""
+    return bool(get_pm25_sensor_ids(station))
+
+def find_nearest_station(lat: float, lon: float, stations: list, require_pm25: bool = False) -> tuple:
+    """
+    Find the station closest to the given coordinates.
+    Returns (station, distance_km), or (None, inf) if no station qualifies.
+    """
+    candidates = []
+    for station in stations:
+        coords = station.get("coordinates") or {}
+        if coords.get("latitude") is None or coords.get("longitude") is None:
+            continue
+        if require_pm25 and not has_pm25_sensor(station):
+            continue
+        candidates.append(station)
+    
+    if not candidates:
+        return None, float('inf')
+    
+    lats = np.array([s["coordinates"]["latitude"] for s in candidates], dtype=np.float64)
+    lons = np.array([s["coordinates"]["longitude"] for s in candidates], dtype=np.float64)
+    
+    if NUMBA_AVAILABLE:
+        kernel = nearest_station_index_parallel if len(candidates) >= PARALLEL_STATION_THRESHOLD else nearest_station_index
+        nearest, distance = kernel(float(lat), float(lon), lats, lons)
+        return candidates[nearest], distance
+    
+    # Without numba the vectorized NumPy path beats a Python loop
+    distances = haversine_distances(lat, lon, lats, lons)
+    nearest = int(np.argmin(distances))
+    return candidates[nearest], float(distances[nearest])
+
+@async_cached(_station_cache, key=lambda lat, lon, radius_meters: (*_grid_key(lat, lon), radius_meters))
+async def search_stations_by_radius(lat: float, lon: float, radius_meters: int) -> Optional[list]:
+    """Search for air quality monitoring stations within a radius (capped at 25km)."""
     params = {
         "coordinates": f"{lat},{lon}",
-        "radius": radius_meters,
+        "radius": min(radius_meters, MAX_SEARCH_RADIUS_METERS),
         "limit": 100
     }
     
     try:
-        response = requests.get(f"{OPENAQ_BASE_URL}/locations", params=params, headers=headers)
-        response.raise_for_status()
-        data = response.json()
+        data = await http_get_json(f"{OPENAQ_BASE_URL}/locations", params=params, headers=OPENAQ_HEADERS)
         return data.get("results", [])
-    except requests.RequestException as e:
-        print(f"Error searching stations: {e}")
+    except (httpx.HTTPError, ValueError) as e:
+        logger.warning("Error searching stations: %s", e)
         return None
 
-def get_sensor_parameter(sensor_id: int) -> Optional[str]:
-    """Get the parameter type for a specific sensor."""
-    headers = {}
-    if OPENAQ_API_KEY:
-        headers["X-API-Key"] = OPENAQ_API_KEY
-    
-    try:
-        response = requests.get(f"{OPENAQ_BASE_URL}/sensors/{sensor_id}", headers=headers)
-        response.raise_for_status()
-        data = response.json()
+async def search_nearest_station(lat: float, lon: float, radii: list, require_pm25: bool = False) -> Optional[tuple]:
+    """
+    Search outward through the given radii (meters) until a qualifying station is found.
+    Returns (station, distance_km), with station None if nothing qualifies,
+    or None if a station search request fails.
+    """
+    for radius in radii:
+        stations = await search_stations_by_radius(lat, lon, radius)
+        if stations is None:
+            return None
         
-        if "results" in data and len(data["results"]) > 0:
-            sensor = data["results"][0]
-            return sensor.get("parameter", {}).get("name")
-        return None
-    except requests.RequestException as e:
-        print(f"Error getting sensor parameter: {e}")
-        return None
+        station, distance = find_nearest_station(lat, lon, stations, require_pm25)
+        if station:
+            return station, distance
+    
+    return None, float('inf')
 
-def get_latest_measurements(location_id: int) -> Optional[dict]:
+async def get_latest_measurements(location_id: int) -> Optional[dict]:
     """Get the latest measurements for a location."""
-    headers = {}
-    if OPENAQ_API_KEY:
-        headers["X-API-Key"] = OPENAQ_API_KEY
-    
     params = {
-        "locations_id": location_id,
-        "limit": 100,
-        "order_by": "datetime",
-        "sort": "desc"
+        "limit": 100
     }
     
     try:
-        response = requests.get(f"{OPENAQ_BASE_URL}/latest", params=params, headers=headers)
-        response.raise_for_status()
-        data = response.json()
+        data = await http_get_json(f"{OPENAQ_BASE_URL}/locations/{location_id}/latest", params=params, headers=OPENAQ_HEADERS)
         return data.get("results", [])
-    except requests.RequestException as e:
-        print(f"Error getting latest measurements: {e}")
+    except (httpx.HTTPError, ValueError) as e:
+        logger.warning("Error getting latest measurements: %s", e)
         return None
 
-def get_weather_data(lat: float, lon: float) -> Optional[dict]:
+@async_cached(_weather_cache, key=_grid_key)
+async def get_weather_data(lat: float, lon: float) -> Optional[dict]:
     """Get current weather data from Open-Meteo API."""
     params = {
         "latitude": lat,
@@ -104,9 +311,7 @@ def get_weather_data(lat: float, lon: float) -> Optional[dict]:
     }
     
     try:
-        response = requests.get(f"{OPEN_METEO_BASE_URL}/forecast", params=params)
-        response.raise_for_status()
-        data = response.json()
+        data = await http_get_json(f"{OPEN_METEO_BASE_URL}/forecast", params=params)
         
         if "current" in data:
             return {
@@ -116,49 +321,117 @@ def get_weather_data(lat: float, lon: float) -> Optional[dict]:
                 "datetime": data["current"].get("time")
             }
         return None
-    except requests.RequestException as e:
-        print(f"Error getting weather data: {e}")
+    except (httpx.HTTPError, ValueError) as e:
+        logger.warning("Error getting weather data: %s", e)
         return None
 
-def save_airquality_csv(data: dict, lat: float, lon: float) -> None:
-    """Save air quality data to CSV file."""
-    filename = f"data/airquality_{lat}_{lon}.csv"
-    
-    # Ensure data directory exists
-    os.makedirs("data", exist_ok=True)
-    
-    # Check if file exists to determine if we need headers
-    file_exists = os.path.exists(filename)
+# Rows are appended by a background task so handlers never wait on disk
+CSV_FIELDNAMES = ['date', 'pm25', 't2m', 'wind_speed', 'relative_humidity']
+CSV_BATCH_SIZE = 100
+
+_csv_queue = None
+_csv_writer_task = None
+_known_csv_files = set()  # files whose directory we've already created
+
+def _write_csv_rows(rows: list) -> None:
+    """Append (filepath, row) pairs to their CSV files, opening each file once."""
+    rows_by_file = {}
+    for filepath, row in rows:
+        rows_by_file.setdefault(filepath, []).append(row)
     
-    with open(filename, 'a', newline='', encoding='utf-8') as csvfile:
-        fieldnames = ['date', 'pm25', 't2m', 'wind_speed', 'relative_humidity']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+    for filepath, file_rows in rows_by_file.items():
+        if filepath not in _known_csv_files:
+            os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
         
-        # Write header if file is new
-        if not file_exists:
-            writer.writeheader()
+        with open(filepath, 'a', newline='', encoding='utf-8') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=CSV_FIELDNAMES)
+            # Append mode starts at the end of the file, so position 0 means it's new (or empty)
+            if csvfile.tell() == 0:
+                writer.writeheader()
+            writer.writerows(file_rows)
         
-        # Write data row
-        writer.writerow({
-            'date': data.get('datetime', ''),
-            'pm25': data.get('pm25', ''),
-            't2m': data.get('t2m', ''),
-            'wind_speed': data.get('wind_speed', ''),
-            'relative_humidity': data.get('relative_humidity', '')
-        })
-
-async def get_air_quality_data(lat: float, lon: float) -> dict:
+        _known_csv_files.add(filepath)
+    
+    # Keep the latest-row index in step so readers don't have to rescan the files
+    try:
+        upsert_latest_rows(rows)
+    except sqlite3.Error as e:
+        logger.warning("Error updating CSV index: %s", e)
+
+async def _csv_writer_loop() -> None:
+    """Drain the CSV queue, writing whatever has accumulated in one batch."""
+    while True:
+        batch = [await _csv_queue.get()]
+        while len(batch) < CSV_BATCH_SIZE and not _csv_queue.empty():
+            batch.append(_csv_queue.get_nowait())
+        
+        try:
+            await asyncio.to_thread(_write_csv_rows, batch)
+        except Exception as e:
+            logger.error("Error saving CSV rows: %s", e)
+        finally:
+            for _ in batch:
+                _csv_queue.task_done()
+
+def start_csv_writer() -> None:
+    """Start the background CSV writer on the running event loop."""
+    global _csv_queue, _csv_writer_task
+    if _csv_writer_task is None:
+        _csv_queue = asyncio.Queue()
+        _csv_writer_task = asyncio.create_task(_csv_writer_loop())
+
+async def flush_csv_writes() -> None:
+    """Wait until every queued CSV row has been written."""
+    if _csv_writer_task is not None:
+        await _csv_queue.join()
+
+async def stop_csv_writer() -> None:
+    """Flush pending rows and stop the background CSV writer."""
+    global _csv_writer_task
+    if _csv_writer_task is not None:
+        await flush_csv_writes()
+        _csv_writer_task.cancel()
+        _csv_writer_task = None
+
+def enqueue_csv_row(filepath: str, row: dict) -> None:
+    """Queue a CSV row for writing, or write it directly if the writer isn't running."""
+    if _csv_writer_task is None:
+        _write_csv_rows([(filepath, row)])
+    else:
+        _csv_queue.put_nowait((filepath, row))
+
+def save_airquality_csv(data: dict, lat: float, lon: float, round_digits: Optional[int] = None) -> None:
+    """
+    Save air quality data to CSV file.
+    Coordinates are rounded in the filename when round_digits is given.
+    """
+    if round_digits is not None:
+        lat, lon = round(lat, round_digits), round(lon, round_digits)
+    
+    enqueue_csv_row(csv_path_for(lat, lon), {
+        'date': data.get('datetime', ''),
+        'pm25': data.get('pm25', ''),
+        't2m': data.get('t2m', ''),
+        'wind_speed': data.get('wind_speed', ''),
+        'relative_humidity': data.get('relative_humidity', '')
+    })
+
+async def get_air_quality_data(lat: float, lon: float, search_radii: tuple = (MAX_SEARCH_RADIUS_METERS,)) -> dict:
     """
     Get air quality data for given coordinates.
     This is the main function that combines air quality and weather data.
+    Stations are searched through search_radii (meters) until one reports PM2.5.
     """
+    # Weather doesn't depend on the OpenAQ lookups, so fetch it concurrently
+    weather_task = asyncio.create_task(get_weather_data(lat, lon))
+    
     try:
-        # Search for nearby stations
-        stations = search_stations_by_radius(lat, lon, 50000)  # 50km radius
+        # Find the closest station with PM2.5 data
+        result = await search_nearest_station(lat, lon, search_radii, require_pm25=True)
         
-        if not stations:
+        if result is None:
             # Get weather data as fallback
-            weather_data = get_weather_data(lat, lon)
+            weather_data = await weather_task
             if weather_data:
                 result = {
                     "location": {"lat": lat, "lon": lon},
@@ -176,34 +449,10 @@ async def get_air_quality_data(lat: float, lon: float) -> dict:
             else:
                 raise Exception("No air quality stations or weather data found")
         
-        # Find the closest station with PM2.5 data
-        closest_station = None
-        min_distance = float('inf')
-        
-        for station in stations:
-            if station.get("coordinates"):
-                coords = station["coordinates"]
-                station_lat = coords.get("latitude")
-                station_lon = coords.get("longitude")
-                
-                if station_lat is not None and station_lon is not None:
-                    distance = haversine_distance(lat, lon, station_lat, station_lon)
-                    
-                    # Check if station has PM2.5 sensors
-                    has_pm25 = False
-                    if "sensors" in station:
-                        for sensor in station["sensors"]:
-                            if sensor.get("parameter", {}).get("name") == "pm25":
-                                has_pm25 = True
-                                break
-                    
-                    if has_pm25 and distance < min_distance:
-                        min_distance = distance
-                        closest_station = station
-        
+        closest_station, min_distance = result
         if not closest_station:
             # Get weather data as fallback
-            weather_data = get_weather_data(lat, lon)
+            weather_data = await weather_task
             if weather_data:
                 result = {
                     "location": {"lat": lat, "lon": lon},
@@ -222,7 +471,7 @@ async def get_air_quality_data(lat: float, lon: float) -> dict:
                 raise Exception("No PM2.5 stations or weather data found")
         
         # Get latest measurements from the closest station
-        measurements = get_latest_measurements(closest_station["id"])
+        measurements = await get_latest_measurements(closest_station["id"])
         
         if not measurements:
             raise Exception("No recent measurements available")
@@ -231,14 +480,17 @@ async def get_air_quality_data(lat: float, lon: float) -> dict:
         pm25_value = None
         measurement_time = None
         
+        # Latest results only carry sensor IDs; the station lists which sensors measure PM2.5
+        pm25_sensor_ids = get_pm25_sensor_ids(closest_station)
+        
         for measurement in measurements:
-            if measurement.get("parameter", {}).get("name") == "pm25":
+            if measurement.get("sensorsId") in pm25_sensor_ids and measurement.get("value") is not None:
                 pm25_value = measurement.get("value")
-                measurement_time = measurement.get("date", {}).get("utc")
+                measurement_time = measurement.get("datetime", {}).get("utc")
                 break
         
         # Get weather data
-        weather_data = get_weather_data(lat, lon)
+        weather_data = await weather_task
         
         # Combine air quality and weather data
         result = {
@@ -266,4 +518,7 @@ async def get_air_quality_data(lat: float, lon: float) -> dict:
         return result
         
     except Exception as e:
-        raise Exception(f"Failed to get air quality data: {str(e)}")
\ No newline at end of file
+        raise Exception(f"Failed to get air quality data: {str(e)}")
+    finally:
+        # No-op once awaited; stops the fetch if we bailed out early
+        weather_task.cancel()
\ No newline at end of file
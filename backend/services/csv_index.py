@@ -0,0 +1,132 @@
+# csv_index.py
+import os
+import sqlite3
+import threading
+from functools import lru_cache
+from typing import Optional, Dict, Any
+
+# Latest row of every data/airquality_*.csv file, so readers don't have to scan the directory
+INDEX_PATH = os.path.join("data", "_index.sqlite")
+
+@lru_cache(maxsize=4096, typed=True)
+def csv_path_for(lat: float, lon: float) -> str:
+    """Path of the CSV file for a coordinate; cached since the same few coordinates recur."""
+    return os.path.join("data", f"airquality_{lat}_{lon}.csv")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS latest (
+    path TEXT PRIMARY KEY,
+    ts TEXT NOT NULL,
+    pm25 REAL,
+    t2m REAL,
+    wind_speed REAL,
+    relative_humidity REAL
+)
+"""
+
+# A file's latest row is the one with the greatest date, the last-written one winning ties,
+# the same as prediction_service's CSV readers. Rows can arrive out of date order (a
+# weather-only row stamped with the current time, then an older station reading), so an
+# entry only moves forward in time.
+_UPSERT = """
+INSERT INTO latest (path, ts, pm25, t2m, wind_speed, relative_humidity)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT(path) DO UPDATE SET
+    ts = excluded.ts,
+    pm25 = excluded.pm25,
+    t2m = excluded.t2m,
+    wind_speed = excluded.wind_speed,
+    relative_humidity = excluded.relative_humidity
+WHERE excluded.ts >= latest.ts
+"""
+
+_COLUMNS = "ts, pm25, t2m, wind_speed, relative_humidity"
+
+# Let SQLite read the index through a memory map instead of copying pages into its cache
+MMAP_SIZE_BYTES = 64 * 1024 * 1024
+
+# One connection shared by the CSV writer thread and request threads, serialized by _lock
+_conn = None
+_lock = threading.Lock()
+
+def _get_connection() -> sqlite3.Connection:
+    """Open the index once, creating it (and data/) if needed. Call with _lock held."""
+    global _conn
+    if _conn is None:
+        os.makedirs(os.path.dirname(INDEX_PATH), exist_ok=True)
+        conn = sqlite3.connect(INDEX_PATH, timeout=10, check_same_thread=False)
+        conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE_BYTES}")
+        conn.execute(_SCHEMA)
+        _conn = conn
+    return _conn
+
+def close_index() -> None:
+    """Close the shared connection; the next call reopens it."""
+    global _conn
+    with _lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+
+def _to_number(value) -> Optional[float]:
+    """CSV cells are strings; blanks are stored as NULL."""
+    if value is None or value == '':
+        return None
+    return float(value)
+
+def _row_to_dict(row: tuple) -> Dict[str, Any]:
+    ts, pm25, t2m, wind_speed, relative_humidity = row
+    return {
+        'date': ts,
+        'pm25': pm25,
+        't2m': t2m,
+        'wind_speed': wind_speed,
+        'relative_humidity': relative_humidity
+    }
+
+def _upsert_params(rows: list) -> list:
+    """SQL parameters for the dated (filepath, csv_row) pairs."""
+    return [
+        (
+            filepath,
+            row['date'],
+            _to_number(row.get('pm25')),
+            _to_number(row.get('t2m')),
+            _to_number(row.get('wind_speed')),
+            _to_number(row.get('relative_humidity')),
+        )
+        for filepath, row in rows
+        if row.get('date')
+    ]
+
+def upsert_latest_rows(rows: list) -> None:
+    """Record (filepath, csv_row) pairs, keeping the most recent dated row per file."""
+    params = _upsert_params(rows)
+    if not params:
+        return
+    
+    with _lock:
+        conn = _get_connection()
+        with conn:
+            conn.executemany(_UPSERT, params)
+
+def rebuild_index(rows: list) -> None:
+    """Replace the index with the given (filepath, csv_row) pairs in one transaction, so readers never see it empty."""
+    params = _upsert_params(rows)
+    with _lock:
+        conn = _get_connection()
+        with conn:
+            conn.execute("DELETE FROM latest")
+            conn.executemany(_UPSERT, params)
+
+def get_latest_row(filepath: str) -> Optional[Dict[str, Any]]:
+    """Latest indexed row for one CSV file, with the date as stored, or None if it isn't indexed."""
+    with _lock:
+        row = _get_connection().execute(f"SELECT {_COLUMNS} FROM latest WHERE path = ?", (filepath,)).fetchone()
+    return _row_to_dict(row) if row else None
+
+def get_latest_row_overall() -> Optional[Dict[str, Any]]:
+    """Most recent indexed row across all CSV files, or None if the index is empty."""
+    with _lock:
+        row = _get_connection().execute(f"SELECT {_COLUMNS} FROM latest ORDER BY ts DESC LIMIT 1").fetchone()
+    return _row_to_dict(row) if row else None
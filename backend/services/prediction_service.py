@@ -1,20 +1,268 @@
 # prediction_service.py
 import os
-import pandas as pd
-from datetime import datetime
-from typing import Optional, Dict, Any
+import csv
+import asyncio
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from datetime import datetime, timezone
+from functools import lru_cache, wraps
+from types import MappingProxyType
+from typing import Optional, Dict, Any, Union
+from cachetools import TTLCache
+from dotenv import load_dotenv
 from forecast.forecast_utils import load_models, forecast_pm25
+from services import csv_index
+from services.air_quality_service import _grid_key
 
-# Load models once when the module is imported
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+
+# Inputs change over minutes to hours, so a coordinate's prediction is reused for this long
+PREDICTION_CACHE_TTL_MINUTES = float(os.getenv("PREDICTION_CACHE_TTL_MINUTES", "10"))
+_prediction_cache = TTLCache(maxsize=4096, ttl=PREDICTION_CACHE_TTL_MINUTES * 60)
+
+# Inputs used when neither the request nor the CSV data provide them
+_DEFAULTS = MappingProxyType({
+    'pm25': 25.0,
+    't2m': 20.0,
+    'wind_speed': 5.0,
+    'relative_humidity': 60.0
+})
+
+def _fill(params: Dict[str, Optional[float]], source) -> Dict[str, float]:
+    """Take each input from params, else from source, else from _DEFAULTS (e.g. for blank CSV cells)."""
+    values = {}
+    for key, default in _DEFAULTS.items():
+        value = params[key]
+        if value is None:
+            value = source.get(key)
+        values[key] = value if value is not None else default
+    return values
+
+@dataclass(slots=True)
+class InputData:
+    """The inputs a prediction was made from."""
+    pm25: float
+    t2m: float
+    wind_speed: float
+    relative_humidity: float
+    timestamp: datetime
+
+@dataclass(slots=True)
+class PredictionResult:
+    """Outcome of predict_air_quality; predictions/input_data are set on success, message on error."""
+    status: str
+    predictions: Optional[Dict[str, float]] = None
+    input_data: Optional[InputData] = None
+    message: Optional[str] = None
+
+def _copy_result(result: PredictionResult) -> PredictionResult:
+    """Copy of a successful result that shares nothing mutable with it, so cached results stay intact."""
+    return replace(result, predictions=dict(result.predictions), input_data=replace(result.input_data))
+
+# Loaded once, at startup (see main.py) or by the first request that needs them
 models = None
+_models_lock = threading.Lock()
 
 def get_models():
     """Get loaded models, loading them if necessary."""
     global models
     if models is None:
-        models = load_models()
+        # Threadpool requests can race here before startup finishes; only one should unpickle
+        with _models_lock:
+            if models is None:
+                models = load_models()
     return models
 
+def lru_memoize(maxsize: int, key):
+    """
+    Thread-safe LRU cache for functions returning a flat dict; hits return a copy.
+    key(*args, **kwargs) builds the cache key from the call arguments.
+    """
+    def decorator(func):
+        cache = OrderedDict()
+        lock = threading.Lock()
+        
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            cache_key = key(*args, **kwargs)
+            with lock:
+                if cache_key in cache:
+                    cache.move_to_end(cache_key)
+                    return dict(cache[cache_key])
+            
+            result = func(*args, **kwargs)
+            with lock:
+                cache[cache_key] = result
+                if len(cache) > maxsize:
+                    cache.popitem(last=False)
+            return dict(result)
+        
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return decorator
+
+# The models only see the inputs plus the hour of day and day of week, so those make an exact key
+@lru_memoize(maxsize=4096, key=lambda models, latest_datetime, pm25, t2m, wind_speed, relative_humidity: (
+    pm25, t2m, wind_speed, relative_humidity, latest_datetime.hour, latest_datetime.weekday()
+))
+def _cached_forecast(models, latest_datetime, pm25, t2m, wind_speed, relative_humidity) -> Dict[str, float]:
+    """forecast_pm25, memoized on the features it actually uses."""
+    return forecast_pm25(models, latest_datetime, pm25, t2m, wind_speed, relative_humidity)
+
+CSV_VALUE_COLUMNS = ('pm25', 't2m', 'wind_speed', 'relative_humidity')
+
+# Rows are usually appended in date order, so the latest one is normally near the end of the file
+TAIL_READ_BYTES = 8192
+
+@lru_cache(maxsize=16)
+def _header_index(header: tuple) -> Dict[str, int]:
+    """Column name -> position; every data file shares one header, so this is computed once."""
+    return {name: i for i, name in enumerate(header)}
+
+def _row_from_values(values: list, header_idx: Dict[str, int]) -> Dict[str, str]:
+    """Build the dict for a single csv.reader row (short rows just lack the trailing columns)."""
+    return {name: values[i] for name, i in header_idx.items() if i < len(values)}
+
+def _latest_dated(rows, date_idx: int) -> Optional[list]:
+    """
+    The csv.reader row with the greatest date, the last-written one winning ties, or None.
+    This is the definition of "latest" shared with the CSV index (see csv_index._UPSERT).
+    """
+    latest = None
+    for values in rows:
+        if latest is None or values[date_idx] >= latest[date_idx]:
+            latest = values
+    return latest
+
+def _read_tail_row(filepath: str) -> Optional[Dict[str, str]]:
+    """
+    Return the row with the greatest date from a CSV file's header and last few KB.
+    Only trusted when the tail's dated rows are in date order (or the tail is the whole file);
+    returns None otherwise, or if the tail holds no dated row or a line doesn't match the header.
+    """
+    with open(filepath, 'rb') as f:
+        header = next(csv.reader([f.readline().decode('utf-8')]), None)
+        f.seek(0, os.SEEK_END)
+        start = max(0, f.tell() - TAIL_READ_BYTES)
+        f.seek(start)
+        # The first line is either the header or cut off by the seek
+        lines = f.read().decode('utf-8', errors='replace').splitlines()[1:]
+    
+    if not header or 'date' not in header:
+        return None
+    header_idx = _header_index(tuple(header))
+    date_idx = header_idx['date']
+    
+    dated = []
+    for values in csv.reader(lines):
+        if not values:
+            continue
+        if len(values) != len(header):
+            return None
+        if values[date_idx]:
+            dated.append(values)
+    if not dated:
+        return None
+    
+    if start == 0:
+        # The tail is the whole file, so its max is exact
+        return _row_from_values(_latest_dated(dated, date_idx), header_idx)
+    
+    # Rows written out of date order (e.g. a weather-only row stamped later than the
+    # station reading appended after it) mean the max may be further back: scan instead
+    if any(earlier[date_idx] > later[date_idx] for earlier, later in zip(dated, dated[1:])):
+        return None
+    return _row_from_values(dated[-1], header_idx)
+
+def _read_latest_raw_row(filepath: str) -> Optional[Dict[str, str]]:
+    """
+    Return the row with the greatest date in a CSV file as raw strings, or None if no row has a date.
+    Dates are UTC ISO 8601 strings, so comparing them as strings orders them chronologically.
+    Reads just the file's tail when that's enough to tell; otherwise streams the whole file.
+    """
+    row = _read_tail_row(filepath)
+    if row is not None:
+        return row
+    
+    with open(filepath, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if not header or 'date' not in header:
+            return None
+        header_idx = _header_index(tuple(header))
+        date_idx = header_idx['date']
+        
+        latest = _latest_dated(
+            (values for values in reader if len(values) > date_idx and values[date_idx]),
+            date_idx
+        )
+    return _row_from_values(latest, header_idx) if latest is not None else None
+
+def _parse_date(value: str) -> datetime:
+    """Parse a stored ISO 8601 date as a UTC datetime."""
+    date = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
+def _parse_row(row: Dict[str, str]) -> Dict[str, Any]:
+    """Convert a raw CSV row to a UTC datetime and floats (None for missing values)."""
+    parsed = {'date': _parse_date(row['date'])}
+    for column in CSV_VALUE_COLUMNS:
+        value = row.get(column)
+        parsed[column] = float(value) if value else None
+    return parsed
+
+@lru_cache(maxsize=1024)
+def _load_latest_row(filepath: str, mtime: float) -> Optional[Dict[str, Any]]:
+    """
+    Return the most recent row of a CSV file, or None if it's empty.
+    Cached on (filepath, mtime), so an unchanged file is only parsed once;
+    call _load_latest_row.cache_clear() to force a re-read.
+    """
+    row = _read_latest_raw_row(filepath)
+    if row is None:
+        logger.debug("CSV file is empty: %s", filepath)
+        return None
+    return _parse_row(row)
+
+def _indexed_row(row: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Index rows already hold floats; only the date needs parsing."""
+    return {**row, 'date': _parse_date(row['date'])} if row else None
+
+# Scans read many small files, so overlap their disk I/O on a shared pool
+_csv_read_executor = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4), thread_name_prefix="csv-read")
+
+def _scan_csv_files(data_dir: str) -> list:
+    """os.DirEntry for each CSV file in data_dir (entry.path is the same as os.path.join(data_dir, name))."""
+    with os.scandir(data_dir) as entries:
+        return [entry for entry in entries if entry.name.endswith('.csv')]
+
+def _try_read(read, filepath: str, *args):
+    """Call read(filepath, *args), logging and returning None if the file can't be read."""
+    try:
+        return read(filepath, *args)
+    except Exception as e:
+        logger.warning("Error reading %s: %s", filepath, e)
+        return None
+
+def rebuild_csv_index() -> None:
+    """Re-index the latest row of every CSV file, e.g. to pick up files written before the index existed."""
+    try:
+        filepaths = [entry.path for entry in _scan_csv_files("data")]
+    except FileNotFoundError:
+        return
+    
+    rows = _csv_read_executor.map(_try_read, [_read_latest_raw_row] * len(filepaths), filepaths)
+    csv_index.rebuild_index([(filepath, row) for filepath, row in zip(filepaths, rows) if row is not None])
+
 def get_data_from_csv_by_coordinates(lat: float, lon: float) -> Optional[Dict[str, Any]]:
     """
     Read data from CSV file for specific coordinates.
@@ -26,37 +274,24 @@ def get_data_from_csv_by_coordinates(lat: float, lon: float) -> Optional[Dict[st
     Returns:
         Dict with the air quality data for the coordinates, or None if not found
     """
-    data_dir = "data"
-    if not os.path.exists(data_dir):
-        return None
+    # Same path the CSV writer uses for these coordinates
+    filepath = csv_index.csv_path_for(lat, lon)
     
-    # Create filename based on coordinates (same format as backend creates)
-    filename = f"airquality_{lat}_{lon}.csv"
-    filepath = os.path.join(data_dir, filename)
-    
-    if not os.path.exists(filepath):
-        print(f"CSV file not found for coordinates {lat}, {lon}: {filepath}")
-        return None
+    try:
+        indexed = _indexed_row(csv_index.get_latest_row(filepath))
+        if indexed is not None:
+            return indexed
+    except sqlite3.Error as e:
+        logger.warning("Error reading CSV index: %s", e)
     
+    # Not indexed (or the index is unavailable): read the file itself
     try:
-        df = pd.read_csv(filepath)
-        if df.empty:
-            print(f"CSV file is empty: {filepath}")
-            return None
-        
-        # Get the most recent row from this file
-        df['date'] = pd.to_datetime(df['date'])
-        latest_row = df.loc[df['date'].idxmax()]
-        
-        return {
-            'date': latest_row['date'],
-            'pm25': latest_row['pm25'],
-            't2m': latest_row['t2m'],
-            'wind_speed': latest_row['wind_speed'],
-            'relative_humidity': latest_row['relative_humidity']
-        }
+        return _load_latest_row(filepath, os.path.getmtime(filepath))
+    except FileNotFoundError:
+        logger.debug("CSV file not found for coordinates %s, %s: %s", lat, lon, filepath)
+        return None
     except Exception as e:
-        print(f"Error reading {filepath}: {e}")
+        logger.warning("Error reading %s: %s", filepath, e)
         return None
 
 def get_latest_data_from_csv() -> Optional[Dict[str, Any]]:
@@ -67,50 +302,92 @@ def get_latest_data_from_csv() -> Optional[Dict[str, Any]]:
     Returns:
         Dict with the latest air quality data, or None if no data found
     """
-    data_dir = "data"
-    if not os.path.exists(data_dir):
+    try:
+        indexed = _indexed_row(csv_index.get_latest_row_overall())
+        if indexed is not None:
+            return indexed
+    except sqlite3.Error as e:
+        logger.warning("Error reading CSV index: %s", e)
+    
+    # Nothing indexed: check every CSV file in the data directory, keeping the most recent row seen
+    try:
+        entries = _scan_csv_files("data")
+    except FileNotFoundError:
         return None
     
+    mtimes = {}
+    for entry in entries:
+        try:
+            mtimes[entry.path] = entry.stat().st_mtime
+        except OSError as e:
+            logger.warning("Error reading %s: %s", entry.path, e)
+    
+    # Unchanged files are (path, mtime) cache hits; the rest are parsed concurrently
+    rows = _csv_read_executor.map(_try_read, [_load_latest_row] * len(mtimes), mtimes.keys(), mtimes.values())
+    
     latest_data = None
-    latest_timestamp = None
-    
-    # Iterate through all CSV files in the data directory
-    for filename in os.listdir(data_dir):
-        if filename.endswith('.csv'):
-            filepath = os.path.join(data_dir, filename)
-            try:
-                df = pd.read_csv(filepath)
-                if not df.empty:
-                    # Get the most recent row from this file
-                    df['date'] = pd.to_datetime(df['date'])
-                    latest_row = df.loc[df['date'].idxmax()]
-                    
-                    # Check if this is the most recent across all files
-                    if latest_timestamp is None or latest_row['date'] > latest_timestamp:
-                        latest_timestamp = latest_row['date']
-                        latest_data = {
-                            'date': latest_row['date'],
-                            'pm25': latest_row['pm25'],
-                            't2m': latest_row['t2m'],
-                            'wind_speed': latest_row['wind_speed'],
-                            'relative_humidity': latest_row['relative_humidity']
-                        }
-            except Exception as e:
-                print(f"Error reading {filename}: {e}")
-                continue
+    for row in rows:
+        if row is not None and (latest_data is None or row['date'] > latest_data['date']):
+            latest_data = row
     
     return latest_data
 
-def predict_air_quality(pm25: Optional[float] = None, 
-                        t2m: Optional[float] = None, 
-                        wind_speed: Optional[float] = None, 
-                        relative_humidity: Optional[float] = None,
-                        lat: Optional[float] = None,
-                        lon: Optional[float] = None) -> Dict[str, Any]:
+def _predict(params: Dict[str, Optional[float]], lat: Optional[float], lon: Optional[float],
+             timestamp: Optional[datetime] = None) -> PredictionResult:
+    """Look up missing inputs, fill them and forecast; the blocking part of predict_air_quality."""
+    try:
+        csv_data = None
+        
+        # Missing inputs come from the CSV file for the coordinates if provided,
+        # else from the latest data in any CSV file, else from _DEFAULTS
+        if lat is not None and lon is not None:
+            csv_data = get_data_from_csv_by_coordinates(lat, lon)
+            if not csv_data:
+                logger.info("No CSV data found for coordinates (%s, %s), using fallback", lat, lon)
+        elif None in params.values():
+            csv_data = get_latest_data_from_csv()
+        
+        if csv_data:
+            values = _fill(params, csv_data)
+            # Both CSV lookups return the date already parsed to a UTC datetime
+            latest_datetime = csv_data['date']
+            source = "data from CSV" if lat is not None and lon is not None else "real data"
+        else:
+            values = _fill(params, _DEFAULTS)
+            latest_datetime = datetime.now()
+            source = "fallback data" if None in params.values() else "provided data"
+        if timestamp is not None:
+            latest_datetime = timestamp
+        
+        logger.debug("Using %s from %s: PM2.5=%s, T=%s°C, Wind=%sm/s, RH=%s%%",
+                     source, latest_datetime, values['pm25'], values['t2m'], values['wind_speed'], values['relative_humidity'])
+        
+        # Make predictions with the models loaded at startup, reusing the result for inputs we've already forecast
+        predictions = _cached_forecast(get_models(), latest_datetime, **values)
+        
+        return PredictionResult(
+            status='success',
+            predictions=predictions,
+            input_data=InputData(timestamp=latest_datetime, **values)
+        )
+        
+    except Exception as e:
+        return PredictionResult(status='error', message=f'Prediction failed: {str(e)}')
+
+async def predict_air_quality(pm25: Optional[float] = None, 
+                              t2m: Optional[float] = None, 
+                              wind_speed: Optional[float] = None, 
+                              relative_humidity: Optional[float] = None,
+                              lat: Optional[float] = None,
+                              lon: Optional[float] = None,
+                              timestamp: Optional[Union[datetime, str]] = None,
+                              refresh: bool = False) -> PredictionResult:
     """
     Predict air quality using the trained models.
     If coordinates are provided, uses data from the specific CSV file for those coordinates.
     If parameters are not provided, uses the latest data from CSV files.
+    CSV lookups (and a first model load) run in a worker thread, off the event loop.
+    Coordinate-only predictions are cached for PREDICTION_CACHE_TTL_MINUTES per ~100 m grid cell.
     
     Args:
         pm25: PM2.5 concentration (μg/m³)
@@ -119,78 +396,34 @@ def predict_air_quality(pm25: Optional[float] = None,
         relative_humidity: Relative humidity (%)
         lat: Latitude (for CSV file lookup)
         lon: Longitude (for CSV file lookup)
+        timestamp: When the given inputs were observed (datetime or ISO 8601 string); defaults to
+            the CSV row's date, or now
+        refresh: Drop any cached prediction for the coordinates (a coordinate-only one is recomputed and re-cached)
     
     Returns:
-        Dictionary containing predictions for different time horizons
+        PredictionResult with predictions for different time horizons, or status 'error' and a message
     """
-    try:
-        # Try to get data from specific CSV if coordinates provided
-        if lat is not None and lon is not None:
-            csv_data = get_data_from_csv_by_coordinates(lat, lon)
-            if csv_data:
-                pm25 = pm25 if pm25 is not None else csv_data['pm25']
-                t2m = t2m if t2m is not None else csv_data['t2m']
-                wind_speed = wind_speed if wind_speed is not None else csv_data['wind_speed']
-                relative_humidity = relative_humidity if relative_humidity is not None else csv_data['relative_humidity']
-                latest_datetime = csv_data['date']
-                print(f"Using data from CSV for coordinates ({lat}, {lon}) from {latest_datetime}: PM2.5={pm25}, T={t2m}°C, Wind={wind_speed}m/s, RH={relative_humidity}%")
-            else:
-                print(f"No CSV data found for coordinates ({lat}, {lon}), using fallback")
-                # Fallback to default values if no CSV data available for coordinates
-                pm25 = pm25 if pm25 is not None else 25.0
-                t2m = t2m if t2m is not None else 20.0
-                wind_speed = wind_speed if wind_speed is not None else 5.0
-                relative_humidity = relative_humidity if relative_humidity is not None else 60.0
-                latest_datetime = datetime.now()
-        # Try to get latest data from any CSV if parameters not provided and no coordinates
-        elif any(param is None for param in [pm25, t2m, wind_speed, relative_humidity]):
-            csv_data = get_latest_data_from_csv()
-            if csv_data:
-                pm25 = pm25 if pm25 is not None else csv_data['pm25']
-                t2m = t2m if t2m is not None else csv_data['t2m']
-                wind_speed = wind_speed if wind_speed is not None else csv_data['wind_speed']
-                relative_humidity = relative_humidity if relative_humidity is not None else csv_data['relative_humidity']
-                latest_datetime = csv_data['date']
-                print(f"Using real data from {latest_datetime}: PM2.5={pm25}, T={t2m}°C, Wind={wind_speed}m/s, RH={relative_humidity}%")
-            else:
-                # Fallback to default values if no CSV data available
-                pm25 = pm25 if pm25 is not None else 25.0
-                t2m = t2m if t2m is not None else 20.0
-                wind_speed = wind_speed if wind_speed is not None else 5.0
-                relative_humidity = relative_humidity if relative_humidity is not None else 60.0
-                latest_datetime = datetime.now()
-                print(f"Using fallback data: PM2.5={pm25}, T={t2m}°C, Wind={wind_speed}m/s, RH={relative_humidity}%")
-        else:
-            latest_datetime = datetime.now()
-            print(f"Using provided data: PM2.5={pm25}, T={t2m}°C, Wind={wind_speed}m/s, RH={relative_humidity}%")
-        
-        # Load models
-        models = load_models()
-        
-        # Make predictions using forecast_pm25 function
-        predictions = forecast_pm25(
-            models, 
-            latest_datetime,
-            pm25, 
-            t2m, 
-            wind_speed, 
-            relative_humidity
-        )
-        
-        return {
-            'status': 'success',
-            'predictions': predictions,
-            'input_data': {
-                'pm25': pm25,
-                't2m': t2m,
-                'wind_speed': wind_speed,
-                'relative_humidity': relative_humidity,
-                'timestamp': latest_datetime.isoformat() if hasattr(latest_datetime, 'isoformat') else str(latest_datetime)
-            }
-        }
-        
-    except Exception as e:
-        return {
-            'status': 'error',
-            'message': f'Prediction failed: {str(e)}'
-        }
\ No newline at end of file
+    params = {'pm25': pm25, 't2m': t2m, 'wind_speed': wind_speed, 'relative_humidity': relative_humidity}
+    if isinstance(timestamp, str):
+        timestamp = _parse_date(timestamp)
+    if refresh and lat is not None and lon is not None:
+        _prediction_cache.pop(_grid_key(lat, lon), None)
+    
+    # Only coordinate-only requests are cached; explicit inputs always get a fresh forecast
+    cache_key = None
+    if lat is not None and lon is not None and (pm25, t2m, wind_speed, relative_humidity) == (None, None, None, None):
+        cache_key = _grid_key(lat, lon)
+        cached = _prediction_cache.get(cache_key)
+        if cached is not None:
+            return _copy_result(cached)
+    
+    if (lat is not None and lon is not None) or None in params.values() or models is None:
+        # File reads or model loading block, so run the whole pipeline in one worker thread
+        result = await asyncio.to_thread(_predict, params, lat, lon, timestamp)
+    else:
+        # All inputs given and models loaded: the forecast is cheaper than a thread hop
+        result = _predict(params, lat, lon, timestamp)
+    
+    if cache_key is not None and result.status == 'success':
+        _prediction_cache[cache_key] = _copy_result(result)
+    return result
@@ -0,0 +1,76 @@
+# test_latest_row.py
+"""
+"Latest" CSV row = greatest date, last-written row winning ties.
+The CSV writer, the SQLite index and every file reader must agree on it.
+"""
+import os
+import pytest
+from services import csv_index, prediction_service, air_quality_service
+
+HEADER = "date,pm25,t2m,wind_speed,relative_humidity\n"
+
+
+@pytest.fixture(autouse=True)
+def data_dir(tmp_path, monkeypatch):
+    """Run each test against an empty data/ directory and a fresh index."""
+    monkeypatch.chdir(tmp_path)
+    csv_index.close_index()
+    prediction_service._load_latest_row.cache_clear()
+    air_quality_service._known_csv_files.clear()
+    yield tmp_path / "data"
+    csv_index.close_index()
+
+
+def write_rows(lat, lon, *rows):
+    """Append rows through the CSV writer, which also updates the index."""
+    air_quality_service._write_csv_rows([
+        (csv_index.csv_path_for(lat, lon), dict(zip(air_quality_service.CSV_FIELDNAMES, row)))
+        for row in rows
+    ])
+
+
+def all_readers(lat, lon):
+    """pm25 of the latest row according to the index, the cached file reader, and a full scan."""
+    filepath = csv_index.csv_path_for(lat, lon)
+    indexed = prediction_service.get_data_from_csv_by_coordinates(lat, lon)
+    from_file = prediction_service._load_latest_row(filepath, os.path.getmtime(filepath))
+    saved_tail = prediction_service.TAIL_READ_BYTES
+    prediction_service.TAIL_READ_BYTES = 0  # force the full scan
+    try:
+        scanned = prediction_service._read_latest_raw_row(filepath)
+    finally:
+        prediction_service.TAIL_READ_BYTES = saved_tail
+    return indexed['pm25'], from_file['pm25'], float(scanned['pm25'])
+
+
+def test_out_of_order_rows_resolve_to_greatest_date():
+    # Weather-only fallback row stamped with Open-Meteo's current time, then an older station reading
+    write_rows(1.5, 2.5, ("2026-10-15T10:00", 5.0, 20, 3, 50))
+    write_rows(1.5, 2.5, ("2026-10-15T09:00:00Z", 99.0, 20, 3, 50))
+
+    assert all_readers(1.5, 2.5) == (5.0, 5.0, 5.0)
+
+
+def test_equal_dates_resolve_to_last_written():
+    write_rows(1.5, 2.5, ("2026-10-15T10:00", 5.0, 20, 3, 50), ("2026-10-15T10:00", 7.0, 20, 3, 50))
+
+    assert all_readers(1.5, 2.5) == (7.0, 7.0, 7.0)
+
+
+def test_out_of_order_rows_beyond_a_large_file_tail(data_dir):
+    write_rows(1.5, 2.5, *[(f"2026-09-{day:02d}T{hour:02d}:00", 1.0, 20, 3, 50)
+                           for day in range(1, 29) for hour in range(24)])
+    write_rows(1.5, 2.5, ("2026-10-15T10:00", 5.0, 20, 3, 50), ("2026-10-15T09:00:00Z", 99.0, 20, 3, 50))
+    assert os.path.getsize(data_dir / "airquality_1.5_2.5.csv") > prediction_service.TAIL_READ_BYTES
+
+    assert all_readers(1.5, 2.5) == (5.0, 5.0, 5.0)
+
+
+def test_rebuilt_index_matches_the_files():
+    write_rows(1.5, 2.5, ("2026-10-15T10:00", 5.0, 20, 3, 50), ("2026-10-15T09:00:00Z", 99.0, 20, 3, 50))
+    write_rows(3.5, 4.5, ("2026-10-15T11:00", 8.0, 20, 3, 50))
+
+    prediction_service.rebuild_csv_index()
+
+    assert all_readers(1.5, 2.5) == (5.0, 5.0, 5.0)
+    assert prediction_service.get_latest_data_from_csv()['pm25'] == 8.0
@@ -0,0 +1,41 @@
+# test_prediction_cache.py
+"""Cached coordinate-only predictions must be shared by nearby coordinates but never by reference."""
+import asyncio
+import numpy as np
+import pytest
+from forecast.forecast_utils import HORIZONS
+from services import csv_index, prediction_service, air_quality_service
+
+
+class EchoPM25Model:
+    """Stand-in model whose forecast is just the pm25 input."""
+
+    def predict(self, X):
+        return np.asarray(X)[:, 0]
+
+
+@pytest.fixture(autouse=True)
+def models(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    csv_index.close_index()
+    prediction_service._load_latest_row.cache_clear()
+    prediction_service._cached_forecast.cache_clear()
+    prediction_service._prediction_cache.clear()
+    air_quality_service._known_csv_files.clear()
+    monkeypatch.setattr(prediction_service, "models", {h: EchoPM25Model() for h in HORIZONS})
+    yield
+    csv_index.close_index()
+    prediction_service._prediction_cache.clear()
+
+
+def test_cached_prediction_is_copied_and_keyed_on_rounded_coordinates():
+    first = asyncio.run(prediction_service.predict_air_quality(lat=1.5, lon=2.5))
+    first.predictions.clear()
+    first.input_data.pm25 = -1.0
+
+    # Float noise from a client lands in the same cache entry, which the mutation above didn't touch
+    second = asyncio.run(prediction_service.predict_air_quality(lat=1.5000000001, lon=2.4999999999))
+
+    assert second.predictions == {f"+{h}h": 25.0 for h in HORIZONS}
+    assert second.input_data.pm25 == 25.0
+    assert len(prediction_service._prediction_cache) == 1
@@ -0,0 +1,71 @@
+# test_prediction_router.py
+"""/predict/from-coordinates must forecast from the data it just fetched."""
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from main import app
+from forecast.forecast_utils import HORIZONS
+from routers import prediction_router
+from services import csv_index, prediction_service, air_quality_service
+
+
+class EchoPM25Model:
+    """Stand-in model whose forecast is just the pm25 input, so tests can see what was used."""
+
+    def predict(self, X):
+        return np.asarray(X)[:, 0]
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    csv_index.close_index()
+    prediction_service._load_latest_row.cache_clear()
+    prediction_service._cached_forecast.cache_clear()
+    prediction_service._prediction_cache.clear()
+    air_quality_service._known_csv_files.clear()
+    monkeypatch.setattr(prediction_service, "models", {h: EchoPM25Model() for h in HORIZONS})
+    yield TestClient(app)
+    csv_index.close_index()
+    prediction_service._cached_forecast.cache_clear()
+
+
+def fetch_returning(current):
+    """get_air_quality_data stand-in that writes its row to the CSV like the real one."""
+    async def fetch(lat, lon):
+        air_quality_service.save_airquality_csv(current, lat, lon)
+        return {"location": {"lat": lat, "lon": lon}, "current": current}
+    return fetch
+
+
+def test_predicts_from_fresh_reading_older_than_a_fallback_row(client, monkeypatch):
+    # OpenAQ down: a weather-only row stamped with Open-Meteo's current time
+    monkeypatch.setattr(prediction_router, "get_air_quality_data", fetch_returning({
+        "pm25": None, "t2m": 20.0, "wind_speed": 3.0, "relative_humidity": 50.0, "datetime": "2026-10-15T10:00"
+    }))
+    assert client.post("/predict/from-coordinates", json={"lat": 1.5, "lon": 2.5}).status_code == 200
+
+    # OpenAQ back: a real reading whose measurement time is older than the fallback row
+    monkeypatch.setattr(prediction_router, "get_air_quality_data", fetch_returning({
+        "pm25": 142.0, "t2m": 20.0, "wind_speed": 3.0, "relative_humidity": 50.0, "datetime": "2026-10-15T09:00:00Z"
+    }))
+    response = client.post("/predict/from-coordinates", json={"lat": 1.5, "lon": 2.5})
+
+    assert response.status_code == 200
+    assert response.json()["predictions"] == {f"+{h}h": 142.0 for h in HORIZONS}
+
+
+def test_fills_missing_reading_from_the_row_stored_before_the_fetch(client, monkeypatch):
+    air_quality_service._write_csv_rows([
+        (csv_index.csv_path_for(1.5, 2.5), {"date": "2026-10-15T08:00:00Z", "pm25": 30.0,
+                                            "t2m": 20.0, "wind_speed": 3.0, "relative_humidity": 50.0})
+    ])
+
+    # No station reports PM2.5 this time, so the appended row's pm25 is blank
+    monkeypatch.setattr(prediction_router, "get_air_quality_data", fetch_returning({
+        "pm25": None, "t2m": 21.0, "wind_speed": 3.0, "relative_humidity": 50.0, "datetime": "2026-10-15T10:00"
+    }))
+    response = client.post("/predict/from-coordinates", json={"lat": 1.5, "lon": 2.5})
+
+    assert response.status_code == 200
+    assert response.json()["predictions"] == {f"+{h}h": 30.0 for h in HORIZONS}